@@ -3,81 +3,107 @@ from __future__ import annotations
 import re
 import sqlite3
 from pathlib import Path
-from typing import Optional
+from typing import List
 
 DB_PATH = Path("data/tcg.sqlite")
 
-SLASH_RE = re.compile(r"^\s*(\d{1,4})\s*/\s*(\d{1,4})\s*$")
 PROMO_ALPHA_RE = re.compile(r"^\s*([A-Z]{2,6})\s*-?\s*(\d{1,4})\s*$", re.I)
+NON_DIGIT_RE = re.compile(r"\D")
+SEPARATOR_RE = re.compile(r"[\s\-]")
 
 def norm_ext_number(raw: str) -> str:
     raw = (raw or "").strip()
     if not raw:
         return raw
 
-    m = SLASH_RE.match(raw)
-    if m:
-        a, b = m.group(1), m.group(2)
-        return f"{int(a)}/{int(b)}"
+    # Pure numeric (e.g., WOTC Black Star Promo numbers)
+    if raw.isdecimal():
+        return str(int(raw))
+
+    # Set numbers like "059/131": split check instead of a regex probe
+    if "/" in raw:
+        a, _, b = raw.partition("/")
+        a, b = a.strip(), b.strip()
+        if a.isdecimal() and b.isdecimal() and len(a) <= 4 and len(b) <= 4:
+            return f"{int(a)}/{int(b)}"
 
     # Normalize things like "SVP 123" -> "SVP123", "SM05" -> "SM05"
-    m2 = PROMO_ALPHA_RE.match(raw.replace(" ", ""))
+    # (needs a leading letter, so skip the regex when raw starts with a digit)
+    m2 = None if raw[0].isdecimal() else PROMO_ALPHA_RE.match(raw.replace(" ", ""))
     if m2:
         prefix = m2.group(1).upper()
         num = int(m2.group(2))
         # Preserve leading zeros for 2-digit promo ids like SM05 by formatting based on original length
         # If original ends with leading zeros, keep width up to 3; otherwise minimal.
-        tail = re.sub(r"\D", "", raw)
+        tail = NON_DIGIT_RE.sub("", raw)
         width = max(2, min(4, len(tail)))  # heuristic
         return f"{prefix}{num:0{width}d}" if tail.startswith("0") else f"{prefix}{num}"
 
-    # Pure numeric (e.g., WOTC Black Star Promo numbers)
-    digits = re.sub(r"\D", "", raw)
-    if digits and digits == raw:
-        return str(int(digits))
-
     # Fallback: uppercase + strip spaces/hyphens
-    return re.sub(r"[\s\-]", "", raw).upper()
+    return SEPARATOR_RE.sub("", raw).upper()
 
 def main() -> None:
     if not DB_PATH.exists():
         raise SystemExit(f"Missing DB: {DB_PATH}")
 
     conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA temp_store=MEMORY;")
     cur = conn.cursor()
 
     # Ensure columns exist
-    cols = {r["name"] for r in cur.execute("PRAGMA table_info(cards);").fetchall()}
+    cols = {r[1] for r in cur.execute("PRAGMA table_info(cards);")}
     if "ext_number_raw" not in cols:
         cur.execute("ALTER TABLE cards ADD COLUMN ext_number_raw TEXT;")
     if "ext_number_norm" not in cols:
         cur.execute("ALTER TABLE cards ADD COLUMN ext_number_norm TEXT;")
 
-    rows = cur.execute("""
+    # Plain tuples (no sqlite3.Row wrapping) for this write-only path
+    pids: List[int] = []
+    ext_raws: List[str] = []
+    for pid, raw in cur.execute("""
         SELECT product_id, collector_number_raw
         FROM cards
         WHERE (ext_number_raw IS NULL OR ext_number_norm IS NULL)
           AND collector_number_raw IS NOT NULL
           AND TRIM(collector_number_raw) <> ''
-    """).fetchall()
-
-    updated = 0
-    for r in rows:
-        pid = r["product_id"]
-        raw = r["collector_number_raw"]
-        ext_raw = raw.strip()
-        ext_norm = norm_ext_number(ext_raw)
-
-        cur.execute("""
-            UPDATE cards
-            SET ext_number_raw = COALESCE(ext_number_raw, ?),
-                ext_number_norm = COALESCE(ext_number_norm, ?)
-            WHERE product_id = ?
-        """, (ext_raw, ext_norm, pid))
-        updated += 1
+    """):
+        pids.append(pid)
+        ext_raws.append(raw.strip())
+
+    sql_update = """
+        UPDATE cards
+        SET ext_number_raw = COALESCE(ext_number_raw, ?),
+            ext_number_norm = COALESCE(ext_number_norm, ?)
+        WHERE product_id = ?
+          AND (ext_number_raw IS NULL OR ext_number_norm IS NULL)
+    """
+
+    # Normalize the whole column in one pass, then push it back with a single executemany
+    # Many cards share a raw number (e.g. "001/102"); normalize each distinct value once
+    norm_by_raw = {raw: norm_ext_number(raw) for raw in set(ext_raws)}
+    ext_norms = list(map(norm_by_raw.__getitem__, ext_raws))
+
+    cur.execute("BEGIN")
+    cur.executemany(sql_update, zip(ext_raws, ext_norms, pids))
+    updated = len(ext_raws)
+
+    # ext_number_* only exist once this script has run, so its OCR lookup index lives
+    # here (the collector_number_norm one is idx_cards_cnorm in schema.sql). Equality
+    # column, then CANDIDATES_SQL's ORDER BY columns; built after the bulk UPDATE so
+    # it isn't maintained row by row.
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_cards_extnorm
+        ON cards (ext_number_norm, group_id, product_name);
+    """)
+    # Wide covering copies created by earlier versions of this script
+    cur.execute("DROP INDEX IF EXISTS idx_cards_cnorm_cover;")
+    cur.execute("DROP INDEX IF EXISTS idx_cards_extnorm_cover;")
 
     conn.commit()
+    # Refresh planner stats so the number indexes are preferred over idx_cards_group_*
+    cur.execute("ANALYZE cards;")
     conn.close()
     print(f"Backfilled ext_number_* for {updated} cards.")
 
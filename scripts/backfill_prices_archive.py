@@ -4,37 +4,53 @@ One-time backfill of TCGCSV daily price archive into prices_history.
 
 Per day:
 - Downloads: https://tcgcsv.com/archive/tcgplayer/prices-YYYY-MM-DD.ppmd.7z
-- Extracts with system `7z` into tmp/tcgcsv_extract/YYYY-MM-DD/
+  (spooled in memory/tmp; written to --cache-dir only with --keep-cache)
+- Extracts in-process with py7zr into tmp/tcgcsv_extract/YYYY-MM-DD/
 - Reads Pokemon category (3): tmp/.../YYYY-MM-DD/3/*/prices
+  (only groups present in `cards` are extracted)
 - Parses JSON shaped as either:
     A) JSON array: [ {...}, {...} ]
     B) JSON object: {"success": true, "results": [ {...}, {...} ]}
     C) line-delimited JSON dicts
 - Keeps only records with non-null marketPrice
-- Filters to your singles universe by requiring productId to exist in `cards`
+- Stages records in a TEMP table, then filters to your singles universe in SQL
+  by requiring productId to exist in `cards`
 - Inserts into prices_history with INSERT OR IGNORE (idempotent)
 - Optionally skips a day if prices_history already has any rows for that snapshot_date
 - Deletes extracted day folder unless --keep-extracted
+- Processes days in parallel (--workers), each worker with its own connection
 
 Requirements:
-- `7z` installed on your system (macOS: `brew install p7zip`)
-- `requests` installed in your venv
+- `requests`, `ijson` and `py7zr` installed in your venv
 """
 
 from __future__ import annotations
 
 import argparse
-import json
+import codecs
+import os
 import shutil
 import sqlite3
-import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from datetime import date, datetime, timedelta, timezone
+from itertools import chain, islice
 from pathlib import Path
-from typing import Iterator, List, Tuple
+from typing import IO, Any, Iterable, Iterator, List, Optional, Tuple
 
+import ijson
+import py7zr
 import requests
 
+try:
+    import orjson as _json
+except ImportError:  # orjson is optional; stdlib json also accepts bytes
+    import json as _json
+
 ARCHIVE_URL_TMPL = "https://tcgcsv.com/archive/tcgplayer/prices-{d}.ppmd.7z"
+SPOOL_MAX_BYTES = 64 * 1024 * 1024
+# 3 bound parameters per row keeps each insert under SQLite's historical 999-variable limit
+STAGE_ROWS_PER_INSERT = 300
 
 
 def utc_now_iso() -> str:
@@ -56,16 +72,57 @@ def ensure_dir(p: Path) -> None:
     p.mkdir(parents=True, exist_ok=True)
 
 
-def download_file(url: str, out_path: Path, timeout: int = 120) -> None:
-    out_path.parent.mkdir(parents=True, exist_ok=True)
-    with requests.get(url, stream=True, timeout=timeout) as r:
-        r.raise_for_status()
-        tmp_path = out_path.with_suffix(out_path.suffix + ".part")
-        with open(tmp_path, "wb") as f:
-            for chunk in r.iter_content(chunk_size=1024 * 1024):
-                if chunk:
-                    f.write(chunk)
-        tmp_path.replace(out_path)
+def download_to_spool(url: str, cache_path: Optional[Path] = None, timeout: int = 120) -> IO[bytes]:
+    """
+    Stream url into a SpooledTemporaryFile (memory up to SPOOL_MAX_BYTES, then a
+    temp file) and return it rewound. With cache_path, the same chunks are also
+    written to the cache file, so the archive is never re-read from disk.
+    """
+    buf = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    tmp_path: Optional[Path] = None
+    try:
+        with requests.get(url, stream=True, timeout=timeout) as r:
+            r.raise_for_status()
+            if cache_path is None:
+                for chunk in r.iter_content(chunk_size=1024 * 1024):
+                    if chunk:
+                        buf.write(chunk)
+            else:
+                cache_path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = cache_path.with_suffix(cache_path.suffix + ".part")
+                with open(tmp_path, "wb") as f:
+                    for chunk in r.iter_content(chunk_size=1024 * 1024):
+                        if chunk:
+                            buf.write(chunk)
+                            f.write(chunk)
+                tmp_path.replace(cache_path)
+    except BaseException:
+        buf.close()
+        if tmp_path is not None:
+            tmp_path.unlink(missing_ok=True)
+        raise
+    buf.seek(0)
+    return buf
+
+
+class Utf8ReplaceReader:
+    """
+    Binary reader that re-emits fp's bytes as valid UTF-8, with invalid sequences
+    replaced by U+FFFD (read_text(errors="replace") semantics), so ijson never sees
+    undecodable bytes while still getting the bytes stream it expects.
+    """
+
+    def __init__(self, fp: IO[bytes]) -> None:
+        self.fp = fp
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def read(self, n: int = -1) -> bytes:
+        while True:
+            chunk = self.fp.read(n)
+            text = self.decoder.decode(chunk, final=not chunk)
+            # An all-partial-sequence chunk decodes to ""; keep reading, since b"" means EOF
+            if text or not chunk:
+                return text.encode("utf-8")
 
 
 def prices_file_records(prices_path: Path) -> Iterator[dict]:
@@ -74,47 +131,51 @@ def prices_file_records(prices_path: Path) -> Iterator[dict]:
     - JSON array: [ {...}, {...} ]
     - JSON object: {"success": true, "results": [ {...}, {...} ]}
     - line-delimited JSON dicts
+
+    Array/object shapes are streamed with ijson, so records are yielded one at a
+    time instead of decoding and materializing the whole file first.
     """
-    raw = prices_path.read_text(encoding="utf-8", errors="replace").strip()
-    if not raw:
-        return
+    with open(prices_path, "rb") as fp:
+        head = fp.read(64).lstrip()
+        if not head:
+            return
+        fp.seek(0)
 
-    # Try full JSON parse first (covers both array and object shapes)
-    try:
-        obj = json.loads(raw)
-        if isinstance(obj, list):
-            for item in obj:
+        # Array -> "item"; object(s) -> "results.item" (also covers one wrapper per line)
+        prefix = "item" if head.startswith(b"[") else "results.item"
+        yielded = 0
+        try:
+            records = ijson.items(Utf8ReplaceReader(fp), prefix, use_float=True, multiple_values=True)
+            for item in records:
                 if isinstance(item, dict):
+                    yielded += 1
                     yield item
+        except ijson.JSONError as e:
+            # Records already went out, so the file is truncated/corrupt mid-stream:
+            # fail the day (its transaction rolls back) instead of loading part of it
+            if yielded:
+                raise ValueError(f"{prices_path}: invalid JSON after {yielded} records: {e}") from e
+        if yielded:
             return
-        if isinstance(obj, dict):
-            results = obj.get("results")
-            if isinstance(results, list):
-                for item in results:
-                    if isinstance(item, dict):
-                        yield item
-                return
-            # if dict but not recognized, fall through to line parsing
-    except json.JSONDecodeError:
-        pass
-
-    # Fallback: line-delimited JSON dicts
-    for line in raw.splitlines():
-        line = line.strip()
-        if not line or not line.startswith("{"):
-            continue
-        try:
-            obj = json.loads(line)
-            if isinstance(obj, dict):
-                # if it's the wrapper dict, unwrap results
-                if "results" in obj and isinstance(obj["results"], list):
-                    for item in obj["results"]:
-                        if isinstance(item, dict):
-                            yield item
-                else:
-                    yield obj
-        except json.JSONDecodeError:
-            continue
+
+        # Fallback: line-delimited JSON dicts
+        fp.seek(0)
+        for raw_line in fp:
+            line = raw_line.decode("utf-8", errors="replace").strip()
+            if not line or not line.startswith("{"):
+                continue
+            try:
+                obj = _json.loads(line)
+                if isinstance(obj, dict):
+                    # if it's the wrapper dict, unwrap results
+                    if "results" in obj and isinstance(obj["results"], list):
+                        for item in obj["results"]:
+                            if isinstance(item, dict):
+                                yield item
+                    else:
+                        yield obj
+            except ValueError:
+                continue
 
 
 def day_already_loaded(con: sqlite3.Connection, snapshot_date: str) -> bool:
@@ -125,131 +186,210 @@ def day_already_loaded(con: sqlite3.Connection, snapshot_date: str) -> bool:
     return row is not None
 
 
-def load_cards_product_ids(con: sqlite3.Connection) -> set[int]:
-    ids: set[int] = set()
-    for (pid,) in con.execute("SELECT DISTINCT product_id FROM cards;"):
-        if pid is not None:
-            ids.add(int(pid))
-    return ids
+def create_staging_table(con: sqlite3.Connection) -> None:
+    con.execute(
+        """
+        CREATE TEMP TABLE IF NOT EXISTS stg_prices (
+          product_id   INTEGER,
+          sub_type     TEXT,
+          market_price REAL
+        );
+        """
+    )
+
+
+def stage_insert_sql(n_rows: int) -> str:
+    values = ", ".join(["(?, ?, ?)"] * n_rows)
+    return f"INSERT INTO stg_prices (product_id, sub_type, market_price) VALUES {values};"
 
 
-def insert_history_rows(
+def stage_price_rows(
     con: sqlite3.Connection,
-    rows: List[Tuple[int, str, float, str, str]],
+    rows: Iterable[Tuple[Any, Any, Any]],
 ) -> None:
-    con.executemany(
+    """
+    rows: raw (productId, subTypeName, marketPrice) values straight from the JSON;
+    the column affinities coerce numeric values and insert_history_from_stage
+    drops whatever did not coerce.
+    """
+    # Multi-row VALUES: one statement step per STAGE_ROWS_PER_INSERT rows instead of per row
+    full_sql = stage_insert_sql(STAGE_ROWS_PER_INSERT)
+    execute, flatten, n = con.execute, chain.from_iterable, STAGE_ROWS_PER_INSERT
+    it = iter(rows)
+    while True:
+        chunk = list(islice(it, n))
+        if not chunk:
+            break
+        sql = full_sql if len(chunk) == n else stage_insert_sql(len(chunk))
+        execute(sql, list(flatten(chunk)))
+
+
+def insert_history_from_stage(con: sqlite3.Connection, snapshot_date: str, captured_at: str) -> Tuple[int, int]:
+    """
+    Move staged rows with a numeric productId/marketPrice whose product_id exists
+    in `cards` into prices_history. Coercion and filtering run in SQLite instead
+    of per-record int()/float()/set lookups in Python.
+    Returns: (rows_with_marketPrice_parsed, rows_kept_after_filter_to_cards)
+    """
+    # Write first: upgrading a read snapshot to a writer can fail with SQLITE_BUSY
+    # (ignoring busy_timeout) when another worker committed in between.
+    con.execute(
         """
         INSERT OR IGNORE INTO prices_history
           (product_id, sub_type, market_price, snapshot_date, captured_at)
-        VALUES (?, ?, ?, ?, ?);
+        SELECT s.product_id, COALESCE(NULLIF(s.sub_type, ''), 'Unknown'), s.market_price, ?, ?
+        FROM stg_prices s
+        WHERE typeof(s.product_id) = 'integer'
+          AND typeof(s.market_price) = 'real'
+          AND EXISTS (SELECT 1 FROM cards c WHERE c.product_id = s.product_id);
         """,
-        rows,
+        (snapshot_date, captured_at),
     )
+    parsed, kept = con.execute(
+        """
+        SELECT
+          COUNT(*),
+          COALESCE(SUM(EXISTS (SELECT 1 FROM cards c WHERE c.product_id = s.product_id)), 0)
+        FROM stg_prices s
+        WHERE typeof(s.product_id) = 'integer'
+          AND typeof(s.market_price) = 'real';
+        """
+    ).fetchone()
+    con.execute("DELETE FROM stg_prices;")
+    return (int(parsed), int(kept))
 
 
-def extract_archive(archive_path: Path, day_extract_dir: Path, verbose: bool) -> None:
+def open_archive(d_str: str, cache_dir: Path, keep_cache: bool, verbose: bool) -> IO[bytes]:
     """
-    Extract archive into day_extract_dir using 7z with cwd set.
-    Use absolute archive path to avoid cwd-related path issues.
+    Return a readable binary file for the day's archive: the cached copy if
+    present, a fresh download into cache_dir with keep_cache, else a spooled
+    in-memory download.
+    """
+    archive_url = ARCHIVE_URL_TMPL.format(d=d_str)
+    archive_path = cache_dir / f"prices-{d_str}.ppmd.7z"
+
+    if archive_path.exists():
+        return open(archive_path, "rb")
+
+    if keep_cache:
+        # Tee into the cache file while spooling, instead of writing then re-reading it
+        if verbose:
+            print(f"[{d_str}] downloading -> {archive_path}")
+        return download_to_spool(archive_url, cache_path=archive_path)
+
+    if verbose:
+        print(f"[{d_str}] downloading (spooled)")
+    return download_to_spool(archive_url)
+
+
+def load_cards_group_ids(con: sqlite3.Connection) -> frozenset[int]:
+    rows = con.execute("SELECT DISTINCT group_id FROM cards;").fetchall()
+    return frozenset(int(r[0]) for r in rows if r[0] is not None)
+
+
+def extract_archive(
+    archive_fp: IO[bytes],
+    day_extract_dir: Path,
+    verbose: bool,
+    d_str: str,
+    group_ids: Optional[frozenset[int]] = None,
+) -> None:
+    """
+    Extract archive into day_extract_dir in-process with py7zr
+    (no `7z` subprocess per day). With group_ids, only the
+    <d_str>/3/<groupId>/prices members for those groups are written out.
     """
     if day_extract_dir.exists():
         shutil.rmtree(day_extract_dir)
     ensure_dir(day_extract_dir)
 
-    archive_abs = archive_path.resolve()
-
     if verbose:
         print(f"extracting -> {day_extract_dir}")
 
-    subprocess.run(
-        ["7z", "x", str(archive_abs)],
-        check=True,
-        cwd=str(day_extract_dir),
-    )
+    with py7zr.SevenZipFile(archive_fp, mode="r") as z:
+        if group_ids is None:
+            z.extractall(path=day_extract_dir)
+            return
+        names = set(z.getnames())
+        targets = [t for t in (f"{d_str}/3/{gid}/prices" for gid in sorted(group_ids)) if t in names]
+        if targets:
+            z.extract(path=day_extract_dir, targets=targets)
+
+
+def connect_db(db_path: str) -> sqlite3.Connection:
+    con = sqlite3.connect(db_path)
+    con.execute("PRAGMA journal_mode=WAL;")
+    con.execute("PRAGMA synchronous=NORMAL;")
+    con.execute("PRAGMA busy_timeout=30000;")
+    return con
+
+
+def price_rows(prices_files: Iterable[Path]) -> Iterator[Tuple[Any, Any, Any]]:
+    """
+    Yield raw (productId, subTypeName, marketPrice) for records with a marketPrice.
+    Only the null check stays in Python; everything else is coerced/filtered in SQL.
+    """
+    for pf in prices_files:
+        for rec in prices_file_records(pf):
+            get = rec.get
+            mp = get("marketPrice")
+            if mp is not None:
+                yield (get("productId"), get("subTypeName"), mp)
 
 
 def backfill_day(
     *,
-    con: sqlite3.Connection,
-    product_ids: set[int],
+    db_path: str,
     d: date,
     cache_dir: Path,
     extract_root: Path,
+    group_ids: Optional[frozenset[int]],
+    keep_cache: bool,
     keep_extracted: bool,
     verbose: bool,
 ) -> Tuple[int, int]:
     """
+    Runs in a worker process; opens its own SQLite connection.
     Returns: (rows_with_marketPrice_parsed, rows_kept_after_filter_to_cards)
     """
     d_str = d.isoformat()
-    archive_url = ARCHIVE_URL_TMPL.format(d=d_str)
-    archive_path = cache_dir / f"prices-{d_str}.ppmd.7z"
 
-    if not archive_path.exists():
-        if verbose:
-            print(f"[{d_str}] downloading -> {archive_path}")
-        download_file(archive_url, archive_path)
-
-    # Extract under tmp/tcgcsv_extract/<date>/
+    # Extract under tmp/tcgcsv_extract/<date>/; removed on every exit path unless kept
     day_extract_dir = extract_root / d_str
-    if verbose:
-        print(f"[{d_str}] ", end="")
-    extract_archive(archive_path, day_extract_dir, verbose=False)
-
-    # Expected extracted structure:
-    #   <day_extract_dir>/<YYYY-MM-DD>/3/<groupId>/prices
-    root = day_extract_dir / d_str / "3"
-    if not root.exists():
-        if not keep_extracted:
-            shutil.rmtree(day_extract_dir, ignore_errors=True)
-        return (0, 0)
-
-    prices_files = list(root.glob("*/prices"))
-    if not prices_files:
-        if not keep_extracted:
-            shutil.rmtree(day_extract_dir, ignore_errors=True)
-        return (0, 0)
-
-    captured_at = utc_now_iso()
-    snapshot_date = d_str
-
-    parsed_with_mp = 0
-    kept = 0
-    batch: List[Tuple[int, str, float, str, str]] = []
-
-    for pf in prices_files:
-        for rec in prices_file_records(pf):
-            mp = rec.get("marketPrice")
-            if mp is None:
-                continue
-
-            try:
-                pid = int(rec.get("productId"))
-            except Exception:
-                continue
-
-            st = rec.get("subTypeName") or "Unknown"
-
-            try:
-                mp_f = float(mp)
-            except Exception:
-                continue
-
-            parsed_with_mp += 1
+    try:
+        with open_archive(d_str, cache_dir, keep_cache, verbose) as archive_fp:
+            if verbose:
+                print(f"[{d_str}] ", end="")
+            extract_archive(archive_fp, day_extract_dir, verbose=False, d_str=d_str, group_ids=group_ids)
 
-            if pid not in product_ids:
-                continue
+        # Expected extracted structure:
+        #   <day_extract_dir>/<YYYY-MM-DD>/3/<groupId>/prices
+        root = day_extract_dir / d_str / "3"
+        if not root.exists():
+            return (0, 0)
 
-            kept += 1
-            batch.append((pid, st, mp_f, snapshot_date, captured_at))
+        prices_files = list(root.glob("*/prices"))
+        if not prices_files:
+            return (0, 0)
 
-    with con:
-        insert_history_rows(con, batch)
+        captured_at = utc_now_iso()
+        snapshot_date = d_str
 
-    if not keep_extracted:
-        shutil.rmtree(day_extract_dir, ignore_errors=True)
+        rows = price_rows(prices_files)
 
-    return (parsed_with_mp, kept)
+        con = connect_db(db_path)
+        try:
+            with con:
+                create_staging_table(con)
+                stage_price_rows(con, rows)
+                parsed_with_mp, kept = insert_history_from_stage(con, snapshot_date, captured_at)
+        finally:
+            con.close()
+
+        return (parsed_with_mp, kept)
+    finally:
+        if not keep_extracted:
+            shutil.rmtree(day_extract_dir, ignore_errors=True)
 
 
 def main() -> None:
@@ -258,9 +398,11 @@ def main() -> None:
     ap.add_argument("--start-date", required=True, help="YYYY-MM-DD")
     ap.add_argument("--end-date", required=True, help="YYYY-MM-DD (inclusive)")
     ap.add_argument("--cache-dir", default="cache/tcgcsv_archive", help="Where to cache .7z archives")
+    ap.add_argument("--keep-cache", action="store_true", help="Write downloaded .7z archives to --cache-dir")
     ap.add_argument("--extract-dir", default="tmp/tcgcsv_extract", help="Where to extract archives")
     ap.add_argument("--skip-existing", action="store_true", help="Skip a day if any history exists for that snapshot_date")
     ap.add_argument("--keep-extracted", action="store_true", help="Keep extracted folders (debug only)")
+    ap.add_argument("--workers", type=int, default=min(4, os.cpu_count() or 1), help="Days processed in parallel")
     ap.add_argument("--verbose", action="store_true")
     args = ap.parse_args()
 
@@ -271,45 +413,69 @@ def main() -> None:
     ensure_dir(cache_dir)
     ensure_dir(extract_dir)
 
-    con = sqlite3.connect(str(db_path))
-    con.execute("PRAGMA journal_mode=WAL;")
-    con.execute("PRAGMA synchronous=NORMAL;")
-
-    product_ids = load_cards_product_ids(con)
-    if args.verbose:
-        print(f"Loaded {len(product_ids):,} product_ids from cards (singles universe)")
+    con = connect_db(str(db_path))
+    # day_already_loaded probes by snapshot_date alone; without this a missing day is a full scan
+    con.execute(
+        "CREATE INDEX IF NOT EXISTS idx_prices_hist_snapshot_date ON prices_history (snapshot_date);"
+    )
 
     start = parse_date(args.start_date)
     end = parse_date(args.end_date)
 
+    days: List[date] = []
     for d in daterange_inclusive(start, end):
-        d_str = d.isoformat()
-
-        if args.skip_existing and day_already_loaded(con, d_str):
+        if args.skip_existing and day_already_loaded(con, d.isoformat()):
             if args.verbose:
-                print(f"[{d_str}] skip (already loaded)")
+                print(f"[{d.isoformat()}] skip (already loaded)")
             continue
+        days.append(d)
 
-        try:
-            parsed_mp, kept = backfill_day(
-                con=con,
-                product_ids=product_ids,
-                d=d,
-                cache_dir=cache_dir,
-                extract_root=extract_dir,
-                keep_extracted=args.keep_extracted,
-                verbose=args.verbose,
+    # Only groups that have cards can contribute rows; skip extracting the rest
+    group_ids = load_cards_group_ids(con)
+    con.close()
+
+    # Days are independent (own archive, extract dir and connection), so fan them out;
+    # results are still reported in date order.
+    failed_days: List[str] = []
+    with ProcessPoolExecutor(max_workers=max(1, args.workers)) as ex:
+        futures = [
+            (
+                d,
+                ex.submit(
+                    backfill_day,
+                    db_path=str(db_path),
+                    d=d,
+                    cache_dir=cache_dir,
+                    extract_root=extract_dir,
+                    group_ids=group_ids,
+                    keep_cache=args.keep_cache,
+                    keep_extracted=args.keep_extracted,
+                    verbose=args.verbose,
+                ),
             )
-            print(f"[{d_str}] parsed_with_marketPrice={parsed_mp:,} kept_in_cards={kept:,}")
-        except requests.HTTPError as e:
-            print(f"[{d_str}] download failed / archive unavailable: {e}")
-            continue
-        except FileNotFoundError as e:
-            raise RuntimeError("Missing `7z` executable. Install with: brew install p7zip") from e
-        except subprocess.CalledProcessError as e:
-            raise RuntimeError(f"7z extraction failed for {d_str}: {e}") from e
+            for d in days
+        ]
 
-    con.close()
+        for d, fut in futures:
+            d_str = d.isoformat()
+            try:
+                parsed_mp, kept = fut.result()
+                print(f"[{d_str}] parsed_with_marketPrice={parsed_mp:,} kept_in_cards={kept:,}")
+            except requests.HTTPError as e:
+                print(f"[{d_str}] download failed / archive unavailable: {e}")
+                continue
+            except py7zr.Bad7zFile as e:
+                ex.shutdown(cancel_futures=True)
+                raise RuntimeError(f"7z extraction failed for {d_str}: {e}") from e
+            except Exception as e:
+                # e.g. a corrupt prices file or a DB error: that day's transaction rolled
+                # back, so report it (a later --skip-existing run retries it) and go on
+                print(f"[{d_str}] FAILED: {type(e).__name__}: {e}")
+                failed_days.append(d_str)
+                continue
+
+    if failed_days:
+        raise SystemExit(f"Backfill finished with {len(failed_days)} failed day(s): {', '.join(failed_days)}")
     print("Backfill complete.")
 
 
@@ -14,17 +14,28 @@ from __future__ import annotations
 import re
 import time
 import sqlite3
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timezone
+from itertools import islice
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import orjson as _json
+except ImportError:  # orjson is optional; stdlib json also accepts bytes
+    import json as _json
 
 ROOT = Path(__file__).resolve().parents[1]
 DB_PATH = ROOT / "data" / "tcg.sqlite"
 
 BASE = "https://tcgcsv.com/tcgplayer"
 CATEGORY_ID = 3  # Pokemon
+FETCH_WORKERS = 8  # concurrent product fetches (polite upper bound for tcgcsv)
+COMMIT_EVERY_GROUPS = 25
 
 
 # ----------------------------
@@ -41,7 +52,7 @@ def get_results(url: str, session: requests.Session, retries: int = 3, timeout:
         try:
             r = session.get(url, timeout=timeout)
             r.raise_for_status()
-            payload = r.json()
+            payload = _json.loads(r.content)
             results = payload.get("results")
             if not isinstance(results, list):
                 raise ValueError(f"Unexpected response shape (missing/invalid 'results'). Keys={list(payload.keys())}")
@@ -52,17 +63,42 @@ def get_results(url: str, session: requests.Session, retries: int = 3, timeout:
     raise last_err  # type: ignore[misc]
 
 
+def fetch_products_in_order(session: requests.Session, group_ids: List[int]) -> Iterator[Tuple[int, Future]]:
+    """
+    Fetch each group's products on a thread pool while the caller processes
+    earlier groups. Yields (group_id, future) in group_ids order and keeps at
+    most 2 * FETCH_WORKERS requests in flight so responses don't pile up.
+    """
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as ex:
+        def submit(gid: int) -> Future:
+            return ex.submit(get_results, f"{BASE}/{CATEGORY_ID}/{gid}/products", session)
+
+        ids = iter(group_ids)
+        pending: Deque[Tuple[int, Future]] = deque((gid, submit(gid)) for gid in islice(ids, FETCH_WORKERS * 2))
+        while pending:
+            gid, fut = pending.popleft()
+            nxt = next(ids, None)
+            if nxt is not None:
+                pending.append((nxt, submit(nxt)))
+            yield gid, fut
+
+
 # ----------------------------
 # Helpers: normalization
 # ----------------------------
 
+WS_RE = re.compile(r"\s+")
+NAME_STRIP_RE = re.compile(r"[^a-z0-9\s\-'/]")
+PREFIX_NUM_RE = re.compile(r"^([A-Z]+)(\d+)$")
+
+
 def clean_name(s: Optional[str]) -> Optional[str]:
     if not s:
         return None
     s = s.strip().lower()
-    s = re.sub(r"\s+", " ", s)
-    s = re.sub(r"[^a-z0-9\s\-'/]", "", s)
-    s = re.sub(r"\s+", " ", s).strip()
+    s = WS_RE.sub(" ", s)
+    s = NAME_STRIP_RE.sub("", s)
+    s = WS_RE.sub(" ", s).strip()
     return s or None
 
 
@@ -71,17 +107,21 @@ def _normalize_num_part(part: str) -> str:
     if not part:
         return part
 
-    m = re.match(r"^([A-Z]+)(\d+)$", part)
-    if m:
-        prefix, digits = m.group(1), m.group(2)
+    if part.isdigit():
         try:
-            return f"{prefix}{int(digits)}"
+            return str(int(part))
         except ValueError:
             return part
 
-    if part.isdigit():
+    # PREFIX_NUM_RE needs a leading A-Z; anything else is returned as-is without a regex probe
+    if not ("A" <= part[0] <= "Z"):
+        return part
+
+    m = PREFIX_NUM_RE.match(part)
+    if m:
+        prefix, digits = m.group(1), m.group(2)
         try:
-            return str(int(part))
+            return f"{prefix}{int(digits)}"
         except ValueError:
             return part
 
@@ -92,7 +132,7 @@ def normalize_collector_number(raw: Optional[str]) -> Optional[str]:
     if not raw:
         return None
     s = raw.strip().upper()
-    s = re.sub(r"\s+", "", s)
+    s = WS_RE.sub("", s)
 
     if "/" in s:
         left, right = s.split("/", 1)
@@ -105,27 +145,29 @@ def normalize_collector_number(raw: Optional[str]) -> Optional[str]:
 # Singles discriminator: Card Number
 # ----------------------------
 
-def extract_card_number(product: Dict[str, Any]) -> Optional[str]:
+def extended_data_values(product: Dict[str, Any]) -> Dict[str, str]:
     """
-    Return the extendedData 'Number' value (Card Number), if present.
+    Map extendedData names to their first non-empty (stripped) value, in one pass,
+    so 'Number' (Card Number) and 'Rarity' are O(1) lookups.
     Example extendedData item:
       { "name": "Number", "displayName": "Card Number", "value": "001/102" }
     """
     ext_list = product.get("extendedData") or []
     if not isinstance(ext_list, list):
-        return None
+        return {}
 
+    ext: Dict[str, str] = {}
     for item in ext_list:
         if not isinstance(item, dict):
             continue
-        if item.get("name") == "Number":
-            val = item.get("value")
-            if val is None:
-                continue
-            val_str = str(val).strip()
-            if val_str:
-                return val_str
-    return None
+        name = item.get("name")
+        val = item.get("value")
+        if name is None or val is None or name in ext:
+            continue
+        val_str = str(val).strip()
+        if val_str:
+            ext[name] = val_str
+    return ext
 
 
 # ----------------------------
@@ -135,6 +177,11 @@ def extract_card_number(product: Dict[str, Any]) -> Optional[str]:
 def db_connect() -> sqlite3.Connection:
     conn = sqlite3.connect(DB_PATH)
     conn.execute("PRAGMA foreign_keys = ON;")
+    conn.execute("PRAGMA journal_mode = WAL;")
+    conn.execute("PRAGMA synchronous = NORMAL;")
+    conn.execute("PRAGMA cache_size = -262144;")  # 256 MiB
+    conn.execute("PRAGMA mmap_size = 1073741824;")  # 1 GiB
+    conn.execute("PRAGMA temp_store = MEMORY;")
     return conn
 
 
@@ -206,12 +253,16 @@ def main():
 
         total_fetched = 0
         total_kept = 0
+        uncommitted_groups = 0
 
         with requests.Session() as session:
-            for i, gid in enumerate(group_ids, start=1):
-                url = f"{BASE}/{CATEGORY_ID}/{gid}/products"
+            adapter = HTTPAdapter(pool_connections=FETCH_WORKERS, pool_maxsize=FETCH_WORKERS)
+            session.mount("https://", adapter)
+
+            # Fetches run ahead on a thread pool; parsing + DB writes stay on this thread
+            for i, (gid, fut) in enumerate(fetch_products_in_order(session, group_ids), start=1):
                 try:
-                    products = get_results(url, session=session)
+                    products = fut.result()
                 except Exception as e:
                     print(f"[{i}/{len(group_ids)}] group_id={gid} ERROR fetching products: {e}")
                     continue
@@ -225,7 +276,8 @@ def main():
                     if not isinstance(p, dict):
                         continue
 
-                    card_number_raw = extract_card_number(p)
+                    ext = extended_data_values(p)
+                    card_number_raw = ext.get("Number")
                     if not card_number_raw:
                         # Not a single (by your discriminator)
                         continue
@@ -238,15 +290,7 @@ def main():
                     card_number_norm = normalize_collector_number(card_number_raw)
 
                     # We can optionally pull rarity if it exists in extendedData; not required for filtering
-                    rarity = None
-                    ext_list = p.get("extendedData") or []
-                    if isinstance(ext_list, list):
-                        for item in ext_list:
-                            if isinstance(item, dict) and item.get("name") == "Rarity":
-                                val = item.get("value")
-                                if val is not None and str(val).strip():
-                                    rarity = str(val).strip()
-                                    break
+                    rarity = ext.get("Rarity")
 
                     rows.append((
                         product_id,
@@ -264,13 +308,17 @@ def main():
 
                 if rows:
                     upsert_cards(conn, rows)
-                    conn.commit()
+                    uncommitted_groups += 1
+                    # One transaction per COMMIT_EVERY_GROUPS groups instead of one per group
+                    if uncommitted_groups >= COMMIT_EVERY_GROUPS:
+                        conn.commit()
+                        uncommitted_groups = 0
 
                 kept = len(rows)
                 total_kept += kept
                 print(f"[{i}/{len(group_ids)}] group_id={gid}: fetched={fetched} kept_singles={kept}")
 
-                time.sleep(0.15)
+        conn.commit()
 
         print("Done.")
         print(f"Total fetched products: {total_fetched}")
@@ -10,6 +10,9 @@ def main():
 
     conn = sqlite3.connect(DB_PATH)
     try:
+        # WAL is persistent in the DB file, so every later connection gets it
+        conn.execute("PRAGMA journal_mode = WAL;")
+        conn.execute("PRAGMA synchronous = NORMAL;")
         schema = SCHEMA_PATH.read_text(encoding="utf-8")
         conn.executescript(schema)
         conn.commit()
@@ -2,18 +2,31 @@ from __future__ import annotations
 
 import argparse
 import sqlite3
+import threading
 import time
-from datetime import datetime, timezone, date
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
+from itertools import islice
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Set, Tuple
+from typing import Any, Callable, Container, Deque, Dict, Iterator, List, Optional, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import orjson as _json
+except ImportError:  # orjson is optional; stdlib json also accepts bytes
+    import json as _json
 
 ROOT = Path(__file__).resolve().parents[1]
 DB_PATH = ROOT / "data" / "tcg.sqlite"
 
 BASE = "https://tcgcsv.com/tcgplayer"
 CATEGORY_ID = 3  # Pokemon
+COMMIT_EVERY_GROUPS = 50  # groups staged between price-write flushes (each flush commits)
+STAGE_FLUSH_ROWS = 20_000  # staged price rows written per INSERT ... SELECT flush
+FETCH_WORKERS = 8  # concurrent price fetches; the rate limiter still bounds request starts
 
 
 def utc_now_iso() -> str:
@@ -21,29 +34,103 @@ def utc_now_iso() -> str:
 
 
 def utc_today_str() -> str:
-    return date.today().isoformat() if datetime.now(timezone.utc).date() == date.today() else datetime.now(timezone.utc).date().isoformat()
+    return datetime.now(timezone.utc).date().isoformat()
 
 
-def get_results(url: str, session: requests.Session, retries: int = 3, timeout: int = 30) -> List[Dict[str, Any]]:
+def get_body(
+    url: str,
+    session: requests.Session,
+    wait: Optional[Callable[[], None]] = None,
+    retries: int = 3,
+    timeout: int = 30,
+) -> bytes:
+    """
+    GET url with retries and return the raw response body. Parsing is left to
+    parse_results on the consuming thread, so responses waiting in the fetch
+    window are held as compact bytes rather than parsed dict lists.
+    This is the only retry layer; wait (the rate limiter) runs before every
+    attempt, so retries respect --throttle-seconds too.
+    """
     last_err: Optional[Exception] = None
     for attempt in range(1, retries + 1):
+        if wait is not None:
+            wait()
         try:
             r = session.get(url, timeout=timeout)
             r.raise_for_status()
-            payload = r.json()
-            results = payload.get("results")
-            if not isinstance(results, list):
-                raise ValueError(f"Unexpected response shape (missing/invalid 'results'). Keys={list(payload.keys())}")
-            return results
+            return r.content
         except Exception as e:
             last_err = e
             time.sleep(0.75 * attempt)
     raise last_err  # type: ignore[misc]
 
 
+def parse_results(body: bytes) -> List[Dict[str, Any]]:
+    payload = _json.loads(body)
+    results = payload.get("results")
+    if not isinstance(results, list):
+        raise ValueError(f"Unexpected response shape (missing/invalid 'results'). Keys={list(payload.keys())}")
+    return results
+
+
+def make_rate_limiter(min_interval: float) -> Callable[[], None]:
+    """
+    Return a thread-safe wait() that spaces successive calls at least
+    min_interval seconds apart across all fetch threads.
+    """
+    lock = threading.Lock()
+    next_at = 0.0
+
+    def wait() -> None:
+        nonlocal next_at
+        with lock:
+            now = time.monotonic()
+            delay = next_at - now
+            next_at = max(now, next_at) + min_interval
+        if delay > 0:
+            time.sleep(delay)
+
+    return wait
+
+
+def fetch_prices_in_order(
+    session: requests.Session,
+    group_ids: List[int],
+    wanted: Container[int],
+    wait: Callable[[], None],
+) -> Iterator[Tuple[int, Optional[Future]]]:
+    """
+    Fetch each group's prices on a thread pool while the caller writes earlier
+    groups. Yields (group_id, future) in group_ids order, with None for groups
+    not in wanted (never fetched), keeping at most 2 * FETCH_WORKERS in flight.
+    """
+    def fetch(gid: int) -> bytes:
+        return get_body(f"{BASE}/{CATEGORY_ID}/{gid}/prices", session=session, wait=wait)
+
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as ex:
+        def submit(gid: int) -> Tuple[int, Optional[Future]]:
+            return gid, (ex.submit(fetch, gid) if gid in wanted else None)
+
+        ids = iter(group_ids)
+        pending: Deque[Tuple[int, Optional[Future]]] = deque(submit(gid) for gid in islice(ids, FETCH_WORKERS * 2))
+        while pending:
+            item = pending.popleft()
+            nxt = next(ids, None)
+            if nxt is not None:
+                pending.append(submit(nxt))
+            yield item
+
+
 def db_connect() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH)
+    # Autocommit mode: main() drives BEGIN IMMEDIATE / COMMIT explicitly
+    conn = sqlite3.connect(DB_PATH, isolation_level=None, cached_statements=256)
     conn.execute("PRAGMA foreign_keys = ON;")
+    conn.execute("PRAGMA journal_mode = WAL;")
+    conn.execute("PRAGMA synchronous = NORMAL;")
+    conn.execute("PRAGMA temp_store = MEMORY;")
+    conn.execute("PRAGMA cache_size = -131072;")  # 128 MiB
+    conn.execute("PRAGMA mmap_size = 268435456;")  # 256 MiB
+    conn.execute("PRAGMA busy_timeout = 5000;")
     return conn
 
 
@@ -58,63 +145,82 @@ def ensure_tables_exist(conn: sqlite3.Connection) -> None:
         )
 
 
-def get_group_ids_in_cards(conn: sqlite3.Connection, only_group_id: Optional[int] = None) -> List[int]:
-    if only_group_id is not None:
-        return [only_group_id]
-    rows = conn.execute("SELECT DISTINCT group_id FROM cards ORDER BY group_id;").fetchall()
-    return [int(r[0]) for r in rows if r and r[0] is not None]
+def ensure_indexes_exist(conn: sqlite3.Connection) -> None:
+    """
+    Covering indexes (also in schema.sql) so the trends lookbacks and the
+    group -> product prefetch are index-only reads on older databases.
+    idx_prices_hist_series_date is a prefix of the covering index, so it is
+    dropped rather than maintained on every history insert.
+    """
+    conn.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_prices_hist_series_date_price
+        ON prices_history (product_id, sub_type, snapshot_date, market_price);
+        """
+    )
+    conn.execute("DROP INDEX IF EXISTS idx_prices_hist_series_date;")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_cards_group_product ON cards (group_id, product_id);")
 
 
-def get_product_ids_for_group(conn: sqlite3.Connection, group_id: int) -> Set[int]:
-    rows = conn.execute("SELECT product_id FROM cards WHERE group_id = ?;", (group_id,)).fetchall()
-    out: Set[int] = set()
-    for r in rows:
-        if r and r[0] is not None:
-            out.add(int(r[0]))
-    return out
+def load_card_group_ids(conn: sqlite3.Connection) -> List[int]:
+    """
+    Distinct group_ids in cards (a covering scan of idx_cards_group_product).
+    Product ids stay in SQLite: filter_staged_prices checks them against cards.
+    """
+    rows = conn.execute("SELECT DISTINCT group_id FROM cards WHERE group_id IS NOT NULL ORDER BY group_id;")
+    return [int(r[0]) for r in rows]
 
 
-def insert_run_log_start(conn: sqlite3.Connection, snapshot_date: str) -> int:
-    started_at = utc_now_iso()
-    cur = conn.execute(
+def is_snapshot_complete(conn: sqlite3.Connection, snapshot_date: str, groups_count: int) -> bool:
+    """
+    True if a previous refresh_prices_daily run for snapshot_date succeeded
+    across at least groups_count groups (so --only-group-id runs don't count).
+    """
+    row = conn.execute(
         """
-        INSERT INTO run_log (job_name, snapshot_date, started_at, status)
-        VALUES (?, ?, ?, ?)
+        SELECT 1 FROM run_log
+        WHERE job_name = 'refresh_prices_daily'
+          AND snapshot_date = ?
+          AND status = 'success'
+          AND groups_count >= ?
+        LIMIT 1;
         """,
-        ("refresh_prices_daily", snapshot_date, started_at, "running"),
-    )
-    conn.commit()
-    return int(cur.lastrowid)
+        (snapshot_date, groups_count),
+    ).fetchone()
+    return row is not None
 
 
-def update_run_log_finish(
+def insert_run_log(
     conn: sqlite3.Connection,
-    run_id: int,
+    snapshot_date: str,
+    started_at: str,
     status: str,
     notes: Optional[str],
-    groups_count: int,
-    price_rows_fetched: int,
-    price_rows_kept: int,
-    latest_upserts: int,
-    history_inserts: int,
-    trends_upserts: int,
+    groups_count: int = 0,
+    price_rows_fetched: int = 0,
+    price_rows_kept: int = 0,
+    latest_upserts: int = 0,
+    history_inserts: int = 0,
+    trends_upserts: int = 0,
 ) -> None:
+    """
+    Write the run's single run_log row once it has finished (success or failed).
+    Does not commit: the success row commits with the run's final transaction.
+    """
     finished_at = utc_now_iso()
     conn.execute(
         """
-        UPDATE run_log
-        SET finished_at = ?,
-            status = ?,
-            groups_count = ?,
-            price_rows_fetched = ?,
-            price_rows_kept = ?,
-            latest_upserts = ?,
-            history_inserts = ?,
-            trends_upserts = ?,
-            notes = ?
-        WHERE run_id = ?
+        INSERT INTO run_log (
+          job_name, snapshot_date, started_at, finished_at, status,
+          groups_count, price_rows_fetched, price_rows_kept,
+          latest_upserts, history_inserts, trends_upserts, notes
+        )
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         """,
         (
+            "refresh_prices_daily",
+            snapshot_date,
+            started_at,
             finished_at,
             status,
             groups_count,
@@ -124,46 +230,128 @@ def update_run_log_finish(
             history_inserts,
             trends_upserts,
             notes,
-            run_id,
         ),
     )
-    conn.commit()
 
 
-def upsert_prices_latest(conn: sqlite3.Connection, rows: List[Tuple[int, str, Optional[float], str]]) -> int:
+def create_stage_table(conn: sqlite3.Connection) -> None:
     """
-    rows: (product_id, sub_type, market_price, updated_at)
+    TEMP staging table for raw price rows, accumulated across groups until a
+    flush. Column affinities coerce numeric strings; filter_staged_prices drops
+    whatever did not coerce.
     """
-    before = conn.total_changes
-    conn.executemany(
+    conn.execute(
+        """
+        CREATE TEMP TABLE IF NOT EXISTS stage_prices (
+          product_id   INTEGER,
+          sub_type     TEXT,
+          market_price REAL
+        );
         """
-        INSERT INTO prices_latest (product_id, sub_type, market_price, updated_at)
-        VALUES (?, ?, ?, ?)
-        ON CONFLICT(product_id, sub_type) DO UPDATE SET
-          market_price = excluded.market_price,
-          updated_at = excluded.updated_at
-        """,
-        rows,
     )
-    conn.commit()
-    return conn.total_changes - before
 
 
-def insert_prices_history(conn: sqlite3.Connection, rows: List[Tuple[int, str, str, Optional[float], str]]) -> int:
+# Hot-path statements: fixed text, so each is prepared once and then served from
+# the connection's statement cache on every group / flush.
+SQL_STAGE_MAX_ROWID = "SELECT COALESCE(MAX(rowid), 0) FROM stage_prices;"
+SQL_STAGE_INSERT = "INSERT INTO stage_prices (product_id, sub_type, market_price) VALUES (?, ?, ?);"
+SQL_STAGE_FILTER = """
+    DELETE FROM stage_prices
+    WHERE rowid > ?
+      AND (
+        typeof(product_id) <> 'integer'
+        OR typeof(market_price) NOT IN ('integer', 'real')
+        OR NOT EXISTS (
+          SELECT 1 FROM cards c
+          WHERE c.product_id = stage_prices.product_id
+            AND c.group_id = ?
+        )
+      )
+"""
+SQL_STAGE_COUNT_AFTER = "SELECT COUNT(*) FROM stage_prices WHERE rowid > ?;"
+SQL_STAGE_CLEAR = "DELETE FROM stage_prices;"
+SQL_UPSERT_LATEST = """
+    INSERT INTO prices_latest (product_id, sub_type, market_price, updated_at)
+    SELECT product_id, COALESCE(NULLIF(sub_type, ''), 'Unknown'), market_price, ?
+    FROM stage_prices
+    WHERE true
+    ORDER BY rowid
+    ON CONFLICT(product_id, sub_type) DO UPDATE SET
+      market_price = excluded.market_price,
+      updated_at = excluded.updated_at
+    WHERE prices_latest.market_price IS NOT excluded.market_price  -- unchanged prices are no-ops
+"""
+SQL_INSERT_HISTORY = """
+    INSERT OR IGNORE INTO prices_history (product_id, sub_type, snapshot_date, market_price, captured_at)
+    SELECT product_id, COALESCE(NULLIF(sub_type, ''), 'Unknown'), ?, market_price, ?
+    FROM stage_prices
+    ORDER BY rowid
+"""
+
+
+def price_stage_rows(price_rows: List[Any]) -> Iterator[Tuple[Any, Any, Any]]:
+    """
+    Yield raw (productId, subTypeName, marketPrice) per dict in price_rows.
+    The only per-row Python work left; coercion/filtering happen in SQL.
+    """
+    for pr in price_rows:
+        if isinstance(pr, dict):
+            get = pr.get
+            yield (get("productId"), get("subTypeName"), get("marketPrice"))
+
+
+def stage_prices(cur: sqlite3.Cursor, price_rows: List[Any]) -> int:
+    """
+    price_rows: raw `results` items from the prices endpoint (non-dicts skipped).
+    Rows are streamed into SQLite one tuple at a time, and snapshot_date /
+    captured_at are bound once per flush statement rather than per row.
+    Returns the stage rowid before this batch, for filter_staged_prices.
+    """
+    after_rowid = int(cur.execute(SQL_STAGE_MAX_ROWID).fetchone()[0])
+    cur.executemany(SQL_STAGE_INSERT, price_stage_rows(price_rows))
+    return after_rowid
+
+
+def filter_staged_prices(cur: sqlite3.Cursor, group_id: int, after_rowid: int) -> int:
     """
-    rows: (product_id, sub_type, snapshot_date, market_price, captured_at)
+    For the batch staged after after_rowid, drop rows without an integer
+    productId / numeric marketPrice, or whose product is not a card in group_id.
+    Returns the number of rows kept from that batch.
+    """
+    cur.execute(SQL_STAGE_FILTER, (after_rowid, group_id))
+    return int(cur.execute(SQL_STAGE_COUNT_AFTER, (after_rowid,)).fetchone()[0])
+
+
+def upsert_prices_latest(cur: sqlite3.Cursor, updated_at: str) -> int:
+    """
+    Upsert the staged rows into prices_latest (staging order, so the last
+    duplicate wins as before). Rows whose price is unchanged are skipped, so
+    the return value counts real inserts/updates only.
+    """
+    before = cur.connection.total_changes
+    cur.execute(SQL_UPSERT_LATEST, (updated_at,))
+    return cur.connection.total_changes - before
+
+
+def insert_prices_history(cur: sqlite3.Cursor, snapshot_date: str, captured_at: str) -> int:
+    """
+    Insert the staged rows into prices_history.
     Idempotent per day via PK(product_id, sub_type, snapshot_date)
     """
-    before = conn.total_changes
-    conn.executemany(
-        """
-        INSERT OR IGNORE INTO prices_history (product_id, sub_type, snapshot_date, market_price, captured_at)
-        VALUES (?, ?, ?, ?, ?)
-        """,
-        rows,
-    )
-    conn.commit()
-    return conn.total_changes - before
+    before = cur.connection.total_changes
+    cur.execute(SQL_INSERT_HISTORY, (snapshot_date, captured_at))
+    return cur.connection.total_changes - before
+
+
+def flush_staged_prices(cur: sqlite3.Cursor, snapshot_date: str, captured_at: str) -> Tuple[int, int]:
+    """
+    Write everything staged so far into prices_latest + prices_history and clear
+    the stage. Returns: (latest_upserts, history_inserts)
+    """
+    latest = upsert_prices_latest(cur, captured_at)
+    history = insert_prices_history(cur, snapshot_date, captured_at)
+    cur.execute(SQL_STAGE_CLEAR)
+    return latest, history
 
 
 def compute_and_upsert_trends(conn: sqlite3.Connection, snapshot_date: str) -> int:
@@ -172,76 +360,61 @@ def compute_and_upsert_trends(conn: sqlite3.Connection, snapshot_date: str) -> i
       pct_change_7d  vs latest snapshot on or before (snapshot_date - 7d)
       pct_change_30d vs latest snapshot on or before (snapshot_date - 30d)
     and upsert into trends_latest.
+
+    Runs as a single INSERT ... SELECT: the lookbacks stay as per-series
+    "latest on or before" index seeks (a bounded window frame would miss series
+    whose last price is older than the frame), and the ratios are computed in SQL.
+    The CTE is MATERIALIZED so each seek runs once rather than once per reference.
+    With idx_prices_hist_series_date_price each seek is one index-only probe, so
+    the cost scales with today's series, not with history length; that is why no
+    pre-aggregated lookback table is maintained.
     """
     computed_at = utc_now_iso()
 
-    # Pull today's series + lookback prices via correlated subqueries (single query)
-    rows = conn.execute(
+    before = conn.total_changes
+    conn.execute(
         """
-        SELECT
-          h.product_id,
-          h.sub_type,
-          h.market_price AS p0,
-          (
-            SELECT h7.market_price
-            FROM prices_history h7
-            WHERE h7.product_id = h.product_id
-              AND h7.sub_type = h.sub_type
-              AND h7.snapshot_date <= date(h.snapshot_date, '-7 day')
-            ORDER BY h7.snapshot_date DESC
-            LIMIT 1
-          ) AS p7,
-          (
-            SELECT h30.market_price
-            FROM prices_history h30
-            WHERE h30.product_id = h.product_id
-              AND h30.sub_type = h.sub_type
-              AND h30.snapshot_date <= date(h.snapshot_date, '-30 day')
-            ORDER BY h30.snapshot_date DESC
-            LIMIT 1
-          ) AS p30
-        FROM prices_history h
-        WHERE h.snapshot_date = ?
-        """,
-        (snapshot_date,),
-    ).fetchall()
-
-    upsert_rows: List[Tuple[int, str, str, Optional[float], Optional[float], Optional[float], Optional[float], Optional[float], str]] = []
-
-    for product_id, sub_type, p0, p7, p30 in rows:
-        pct7 = None
-        pct30 = None
-
-        # Guard against null/zero
-        if p0 is not None and p7 is not None and float(p7) != 0.0:
-            pct7 = (float(p0) - float(p7)) / float(p7)
-        if p0 is not None and p30 is not None and float(p30) != 0.0:
-            pct30 = (float(p0) - float(p30)) / float(p30)
-
-        upsert_rows.append(
+        WITH lookback AS MATERIALIZED (  -- evaluate each lookback seek once per series
+          SELECT
+            h.product_id,
+            h.sub_type,
+            h.snapshot_date,
+            h.market_price AS p0,
+            (
+              SELECT h7.market_price
+              FROM prices_history h7
+              WHERE h7.product_id = h.product_id
+                AND h7.sub_type = h.sub_type
+                AND h7.snapshot_date <= date(h.snapshot_date, '-7 day')
+              ORDER BY h7.snapshot_date DESC
+              LIMIT 1
+            ) AS p7,
             (
-                int(product_id),
-                str(sub_type),
-                snapshot_date,
-                float(p0) if p0 is not None else None,
-                float(p7) if p7 is not None else None,
-                float(p30) if p30 is not None else None,
-                pct7,
-                pct30,
-                computed_at,
-            )
+              SELECT h30.market_price
+              FROM prices_history h30
+              WHERE h30.product_id = h.product_id
+                AND h30.sub_type = h.sub_type
+                AND h30.snapshot_date <= date(h.snapshot_date, '-30 day')
+              ORDER BY h30.snapshot_date DESC
+              LIMIT 1
+            ) AS p30
+          FROM prices_history h
+          WHERE h.snapshot_date = ?
         )
-
-    before = conn.total_changes
-    conn.executemany(
-        """
         INSERT INTO trends_latest (
           product_id, sub_type, snapshot_date,
           market_price, market_price_7d, market_price_30d,
           pct_change_7d, pct_change_30d,
           computed_at
         )
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        SELECT
+          product_id, sub_type, snapshot_date,
+          p0, p7, p30,
+          (p0 - p7) / NULLIF(p7, 0),     -- NULL when either side is NULL or p7 = 0
+          (p0 - p30) / NULLIF(p30, 0),
+          ?
+        FROM lookback
+        WHERE true  -- disambiguates ON CONFLICT after INSERT ... SELECT
         ON CONFLICT(product_id, sub_type) DO UPDATE SET
           snapshot_date = excluded.snapshot_date,
           market_price = excluded.market_price,
@@ -251,9 +424,8 @@ def compute_and_upsert_trends(conn: sqlite3.Connection, snapshot_date: str) -> i
           pct_change_30d = excluded.pct_change_30d,
           computed_at = excluded.computed_at
         """,
-        upsert_rows,
+        (snapshot_date, computed_at),
     )
-    conn.commit()
     return conn.total_changes - before
 
 
@@ -261,119 +433,143 @@ def main():
     parser = argparse.ArgumentParser(description="Daily marketPrice refresh + trends (variant-aware).")
     parser.add_argument("--snapshot-date", help="UTC snapshot date YYYY-MM-DD (default: today UTC).")
     parser.add_argument("--only-group-id", type=int, help="Limit run to a single group_id for testing.")
-    parser.add_argument("--throttle-seconds", type=float, default=0.15, help="Sleep between groups (default: 0.15).")
+    parser.add_argument(
+        "--throttle-seconds",
+        type=float,
+        default=0.15,
+        help="Minimum spacing between price requests across fetch threads (default: 0.15).",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Re-fetch prices even if a successful run already covered --snapshot-date.",
+    )
     args = parser.parse_args()
 
     if not DB_PATH.exists():
         raise RuntimeError(f"Database not found at {DB_PATH}. Run: python scripts/init_db.py")
 
-    snapshot_date = args.snapshot_date or datetime.now(timezone.utc).date().isoformat()
+    snapshot_date = args.snapshot_date or utc_today_str()
     captured_at = utc_now_iso()
+    started_at = captured_at
 
     conn = db_connect()
     try:
         ensure_tables_exist(conn)
+        ensure_indexes_exist(conn)
 
-        run_id = insert_run_log_start(conn, snapshot_date)
-
-        group_ids = get_group_ids_in_cards(conn, only_group_id=args.only_group_id)
+        card_group_ids = load_card_group_ids(conn)
+        group_ids = [args.only_group_id] if args.only_group_id is not None else card_group_ids
         if not group_ids:
-            update_run_log_finish(
-                conn,
-                run_id,
-                "failed",
-                "No group_ids found in cards table. Ingest cards first.",
-                0, 0, 0, 0, 0, 0
-            )
             raise RuntimeError("No group_ids found in cards table. Ingest cards first.")
 
+        notes: Optional[str] = None
+        if (
+            args.only_group_id is None
+            and not args.force
+            and is_snapshot_complete(conn, snapshot_date, len(group_ids))
+        ):
+            # Reruns of a finished day only refresh trends; --force re-fetches everything
+            notes = "snapshot already complete; trends only"
+            print(f"snapshot_date {snapshot_date} already complete; recomputing trends only (use --force to re-fetch).")
+            group_ids = []
+
         total_fetched = 0
         total_kept = 0
         total_latest_upserts = 0
         total_history_inserts = 0
+        failed_group_ids: List[int] = []
+
+        # Fetching and staging hold no main-DB write lock (stage_prices is TEMP); only
+        # each flush, every COMMIT_EVERY_GROUPS groups or STAGE_FLUSH_ROWS rows, runs
+        # in a short BEGIN IMMEDIATE transaction. The last flush, trends and the run's
+        # single run_log row are committed together at the end.
+        create_stage_table(conn)
+        cur = conn.cursor()  # one cursor for every hot-path statement
+        staged = 0
+        unflushed_groups = 0
 
         with requests.Session() as session:
-            for idx, gid in enumerate(group_ids, start=1):
-                valid_ids = get_product_ids_for_group(conn, gid)
-                if not valid_ids:
+            # One host, so one keep-alive pool with a socket per fetch thread; TLS
+            # handshakes happen once per socket, not once per group.
+            # No adapter-level retries: get_body retries (rate-limited) on its own
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=FETCH_WORKERS, pool_block=True)
+            session.mount("https://", adapter)
+            wait = make_rate_limiter(max(0.0, float(args.throttle_seconds)))
+
+            # Fetches run ahead on a thread pool; parsing + DB writes stay on this thread
+            fetches = fetch_prices_in_order(session, group_ids, frozenset(card_group_ids), wait)
+            for idx, (gid, fut) in enumerate(fetches, start=1):
+                if fut is None:
                     print(f"[{idx}/{len(group_ids)}] group_id={gid}: no cards in DB, skipping.")
                     continue
 
-                url = f"{BASE}/{CATEGORY_ID}/{gid}/prices"
-
+                # Only one group's parsed rows are alive at a time; staging streams them
                 try:
-                    price_rows = get_results(url, session=session)
+                    price_rows = parse_results(fut.result())
                 except Exception as e:
                     print(f"[{idx}/{len(group_ids)}] group_id={gid}: ERROR fetching prices: {e}")
+                    failed_group_ids.append(gid)
                     continue
 
                 fetched = len(price_rows)
                 total_fetched += fetched
 
-                latest_rows: List[Tuple[int, str, Optional[float], str]] = []
-                hist_rows: List[Tuple[int, str, str, Optional[float], str]] = []
-
-                kept = 0
-                for pr in price_rows:
-                    if not isinstance(pr, dict):
-                        continue
-
-                    pid = pr.get("productId")
-                    if pid is None:
-                        continue
-                    try:
-                        pid_int = int(pid)
-                    except Exception:
-                        continue
-
-                    if pid_int not in valid_ids:
-                        continue
-
-                    sub_type = pr.get("subTypeName") or "Unknown"
-                    mp = pr.get("marketPrice", None)
-                    try:
-                        mp_val = float(mp) if mp is not None else None
-                    except Exception:
-                        mp_val = None
-
-                    # We still store rows even if market_price is None; your choice:
-                    # For cleaner analytics, you may prefer to skip None values.
-                    if mp_val is None:
-                        continue
-
-                    kept += 1
-                    latest_rows.append((pid_int, str(sub_type), mp_val, captured_at))
-                    hist_rows.append((pid_int, str(sub_type), snapshot_date, mp_val, captured_at))
-
+                # Coercion and filtering to this group's cards run in SQLite; kept rows
+                # accumulate in the stage and are written STAGE_FLUSH_ROWS at a time
+                # Deferred transaction: writes only the TEMP stage, reads cards
+                conn.execute("BEGIN")
+                kept = filter_staged_prices(cur, gid, stage_prices(cur, price_rows))
+                conn.commit()
+                del price_rows
                 total_kept += kept
-
-                # write latest + history
-                if latest_rows:
-                    total_latest_upserts += upsert_prices_latest(conn, latest_rows)
-                if hist_rows:
-                    total_history_inserts += insert_prices_history(conn, hist_rows)
+                staged += kept
+
+                unflushed_groups += 1
+                if staged >= STAGE_FLUSH_ROWS or unflushed_groups >= COMMIT_EVERY_GROUPS:
+                    conn.execute("BEGIN IMMEDIATE")
+                    latest, history = flush_staged_prices(cur, snapshot_date, captured_at)
+                    conn.commit()
+                    total_latest_upserts += latest
+                    total_history_inserts += history
+                    staged = 0
+                    unflushed_groups = 0
 
                 print(f"[{idx}/{len(group_ids)}] group_id={gid}: fetched={fetched} kept(with marketPrice)={kept}")
 
-                time.sleep(max(0.0, float(args.throttle_seconds)))
+        conn.execute("BEGIN IMMEDIATE")
+        if staged:
+            latest, history = flush_staged_prices(cur, snapshot_date, captured_at)
+            total_latest_upserts += latest
+            total_history_inserts += history
 
         # trends step (uses prices_history for snapshot_date)
         trends_upserts = compute_and_upsert_trends(conn, snapshot_date)
 
-        update_run_log_finish(
+        # A day with failed group fetches is logged as 'partial' (never 'success'), so
+        # is_snapshot_complete doesn't skip the re-fetch on the next run
+        status = "success"
+        if failed_group_ids:
+            status = "partial"
+            notes = f"{len(failed_group_ids)} group fetches failed: " + ",".join(map(str, failed_group_ids))
+            notes = notes[:500]
+
+        insert_run_log(
             conn,
-            run_id,
-            "success",
-            None,
-            len(group_ids),
+            snapshot_date,
+            started_at,
+            status,
+            notes,
+            len(group_ids) - len(failed_group_ids),
             total_fetched,
             total_kept,
             total_latest_upserts,
             total_history_inserts,
             trends_upserts,
         )
+        conn.commit()
 
-        print("Done.")
+        print("Done." if status == "success" else f"Done with {len(failed_group_ids)} failed groups (logged as partial).")
         print(f"snapshot_date (UTC): {snapshot_date}")
         print(f"price_rows_fetched:  {total_fetched}")
         print(f"price_rows_kept:     {total_kept}")
@@ -382,12 +578,12 @@ def main():
         print(f"trends_upserts:      {trends_upserts}")
 
     except Exception as e:
-        # best-effort: mark run failed if we already created it
+        # best-effort: record the failed run. Flushes already committed stay; an open
+        # transaction is rolled back so it isn't committed with the 'failed' row.
         try:
-            conn.execute(
-                "UPDATE run_log SET status='failed', finished_at=?, notes=? WHERE status='running' AND job_name=? AND snapshot_date=?;",
-                (utc_now_iso(), str(e)[:500], "refresh_prices_daily", snapshot_date),
-            )
+            if conn.in_transaction:
+                conn.rollback()
+            insert_run_log(conn, snapshot_date, started_at, "failed", str(e)[:500])
             conn.commit()
         except Exception:
             pass
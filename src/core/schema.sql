@@ -21,6 +21,14 @@ ON cards (group_id, clean_name);
 CREATE INDEX IF NOT EXISTS idx_cards_group_type
 ON cards (group_id, product_type);
 
+CREATE INDEX IF NOT EXISTS idx_cards_group_product
+ON cards (group_id, product_id);
+
+-- OCR lookup by number across all sets (streamlit_ocr_test.CANDIDATES_SQL):
+-- equality column, then the ORDER BY columns
+CREATE INDEX IF NOT EXISTS idx_cards_cnorm
+ON cards (collector_number_norm, group_id, product_name);
+
 -- ----------------------------
 -- Pricing (marketPrice-only, variant-aware)
 -- ----------------------------
@@ -29,7 +37,7 @@ CREATE TABLE IF NOT EXISTS prices_latest (
   product_id   INTEGER NOT NULL REFERENCES cards(product_id),
   sub_type     TEXT NOT NULL,               -- e.g., Normal / Holofoil / Reverse Holofoil
   market_price REAL,
-  updated_at   TEXT NOT NULL,               -- UTC timestamp of last refresh
+  updated_at   TEXT NOT NULL,               -- UTC timestamp of the refresh that last changed market_price
   PRIMARY KEY (product_id, sub_type)
 );
 
@@ -42,8 +50,13 @@ CREATE TABLE IF NOT EXISTS prices_history (
   PRIMARY KEY (product_id, sub_type, snapshot_date)
 );
 
-CREATE INDEX IF NOT EXISTS idx_prices_hist_series_date
-ON prices_history (product_id, sub_type, snapshot_date);
+CREATE INDEX IF NOT EXISTS idx_prices_hist_snapshot_date
+ON prices_history (snapshot_date);
+
+-- Covering index for the trends "latest price on or before" lookbacks; replaces
+-- idx_prices_hist_series_date (same prefix), which refresh_prices_daily drops
+CREATE INDEX IF NOT EXISTS idx_prices_hist_series_date_price
+ON prices_history (product_id, sub_type, snapshot_date, market_price);
 
 -- ----------------------------
 -- Trends (latest snapshot only)
@@ -72,7 +85,7 @@ CREATE TABLE IF NOT EXISTS run_log (
   snapshot_date         TEXT NOT NULL,
   started_at            TEXT NOT NULL,
   finished_at           TEXT,
-  status                TEXT NOT NULL,      -- running / success / failed
+  status                TEXT NOT NULL,      -- running / success / partial / failed
   groups_count          INTEGER DEFAULT 0,
   price_rows_fetched    INTEGER DEFAULT 0,
   price_rows_kept       INTEGER DEFAULT 0,
@@ -102,9 +115,13 @@ CREATE TABLE IF NOT EXISTS ocr_runs (
 );
 
 -- OCR extracted + parsed data (one row per run)
+-- Rows written since full_text_zlib was added keep the OCR text only there, compressed,
+-- with full_text = ''; readers must use full_text_zlib when it is non-NULL
+-- (streamlit_ocr_test.decompress_full_text) and fall back to full_text otherwise.
 CREATE TABLE IF NOT EXISTS ocr_results (
   run_id                 INTEGER PRIMARY KEY,
-  full_text              TEXT NOT NULL,
+  full_text              TEXT NOT NULL,                    -- '' when full_text_zlib is set
+  full_text_zlib         BLOB,                             -- zlib(UTF-8 OCR text); NULL on older rows
   collector_number_raw   TEXT,
   collector_number_norm  TEXT,
   name_hint              TEXT,
@@ -1,43 +1,72 @@
 from __future__ import annotations
 
 import hashlib
+import io
 import re
 import sqlite3
 import time
+import zlib
+from contextlib import contextmanager
 from datetime import datetime, timezone
+from itertools import islice
 from pathlib import Path
-from typing import Optional, Dict, Any, Tuple
+from typing import Optional, Dict, Any, Iterator, List, Tuple
 
 import pandas as pd
 import streamlit as st
 
 DB_PATH = Path("data/tcg.sqlite")
 
+# Long-side cap for images sent to Vision; card text OCR doesn't improve past this
+OCR_MAX_SIDE = 1600
+
 # -----------------------------
 # Regex helpers
 # -----------------------------
 
-# Standard set number like 059/131
-SLASH_RE = re.compile(r"\b(\d{1,4}\s*/\s*\d{1,4})\b")
-
-# Promo-like identifiers: SM05, SM125, SWSH125, SVP 123, XY123, BW123, etc.
-PROMO_RE = re.compile(r"\b(SVP|SWSH|SM|XY|BW|DP|HGSS|POP)\s*-?\s*(\d{1,4})\b", re.I)
-
-# WOTC-ish: word PROMO then a small integer somewhere shortly after (e.g., PROMO ... 28)
-WOTC_PROMO_NUM_RE = re.compile(r"\bPROMO\b[\s\S]{0,140}?\b(\d{1,3})\b", re.I)
+# One scan for all card-number shapes. Each alternative sits inside a lookahead,
+# so matches are zero-width and one shape can't swallow another's text; at most
+# one alternative can match at a given position (digit vs. promo letters vs. PROMO).
+#   slash: standard set number like 059/131
+#   promo_prefix/promo_num: promo-like ids: SM05, SM125, SWSH125, SVP 123, XY123, BW123, etc.
+#   wotc_num: WOTC-ish: word PROMO then a small integer shortly after (e.g., PROMO ... 28)
+# Stays on stdlib `re`: RE2/Hyperscan don't support the lookahead, and backtracking
+# is bounded anyway (every repeat is capped, the lazy WOTC gap at 140 chars).
+CARD_NUMBER_RE = re.compile(
+    r"(?="
+    r"(?P<slash>\b\d{1,4}\s*/\s*\d{1,4}\b)"
+    r"|\b(?P<promo_prefix>SVP|SWSH|SM|XY|BW|DP|HGSS|POP)\s*-?\s*(?P<promo_num>\d{1,4})\b"
+    r"|\bPROMO\b[\s\S]{0,140}?\b(?P<wotc_num>\d{1,3})\b"
+    r")",
+    re.I,
+)
+
+# Name-line cleanup: keep letters/digits/apostrophes/hyphens/spaces/&, then collapse whitespace
+NAME_CLEAN_RE = re.compile(r"[^A-Za-z0-9'’\-\s&]")
+WS_RE = re.compile(r"\s+")
+
+# Separators dropped when normalizing promo ids
+PROMO_SEP_RE = re.compile(r"[\s\-]")
+
+# Lines containing any of these (lowercased) are card boilerplate, not the name line;
+# one compiled alternation instead of a Python-level substring test per word
+NAME_BOILERPLATE_RE = re.compile(r"weakness|resistance|retreat|illus|rule")
 
 # Tokens to ignore when trying to pull the Pokémon name from OCR
-STOPWORDS = {
+STOPWORDS = frozenset({
     "basic", "stage", "pokemon", "pokémon", "trainer", "energy",
     "hp", "weakness", "resistance", "retreat", "rule", "illus",
     "illustration", "attack", "attacks", "ability", "abilities",
-}
+})
 
 # Suffixes we strip from the name line if present (we want base Pokémon name)
-CARD_SUFFIXES = {
+CARD_SUFFIXES = frozenset({
     "gx", "ex", "v", "vmax", "vstar", "lv", "lvl", "tag", "team",
     "break", "prime", "δ", "delta", "radiant",
-}
+})
+
+# Every token dropped from a name line (stopwords, suffixes, lone "&"): one lookup per token
+NAME_DROP_TOKENS = STOPWORDS | CARD_SUFFIXES | {"&"}
 
 # -----------------------------
 # Utility
@@ -47,13 +76,39 @@ def utc_now_iso() -> str:
     return datetime.now(timezone.utc).isoformat(timespec="seconds")
 
 def sha256_hex(b: bytes) -> str:
+    # hashlib's SHA-256 is OpenSSL-backed (SHA-NI where the CPU has it); kept over
+    # BLAKE3 since ocr_runs.image_sha256 is the stored content id
     return hashlib.sha256(b).hexdigest()
 
-def get_conn() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH)
+def open_conn() -> sqlite3.Connection:
+    """
+    New tuned connection. Only call once DB_PATH exists; go through get_conn().
+    check_same_thread=False because a session's reruns may run on different threads.
+    """
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA busy_timeout=5000;")
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    conn.execute("PRAGMA mmap_size=268435456;")  # 256 MiB
+    conn.execute("PRAGMA cache_size=-65536;")  # 64 MiB
     return conn
 
+@contextmanager
+def get_conn() -> Iterator[sqlite3.Connection]:
+    """
+    This session's connection (opened once, reused across reruns) for one unit of
+    work, committed on success and rolled back on error. Sessions never share a
+    connection, so one session's commit/rollback can't end another's transaction,
+    and WAL lets their reads run while another session writes.
+    """
+    conn = st.session_state.get("db_conn")
+    if conn is None:
+        conn = st.session_state["db_conn"] = open_conn()
+    with conn:
+        yield conn
+
 def ensure_ocr_tables(conn: sqlite3.Connection) -> None:
     conn.executescript(
         """
@@ -72,6 +127,7 @@ def ensure_ocr_tables(conn: sqlite3.Connection) -> None:
         CREATE TABLE IF NOT EXISTS ocr_results (
           run_id                 INTEGER PRIMARY KEY,
           full_text              TEXT NOT NULL,
+          full_text_zlib         BLOB,
           collector_number_raw   TEXT,
           collector_number_norm  TEXT,
           promo_number_raw       TEXT,
@@ -85,13 +141,26 @@ def ensure_ocr_tables(conn: sqlite3.Connection) -> None:
         );
 
         CREATE INDEX IF NOT EXISTS idx_ocr_runs_created_at ON ocr_runs(created_at);
+        CREATE INDEX IF NOT EXISTS idx_ocr_runs_image_sha256 ON ocr_runs(image_sha256);
         CREATE INDEX IF NOT EXISTS idx_ocr_results_collector_norm ON ocr_results(collector_number_norm);
         CREATE INDEX IF NOT EXISTS idx_ocr_results_promo_norm ON ocr_results(promo_number_norm);
         """
     )
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(ocr_results);")}
+    if "full_text_zlib" not in cols:
+        conn.execute("ALTER TABLE ocr_results ADD COLUMN full_text_zlib BLOB;")
     conn.commit()
 
-def save_run(conn: sqlite3.Connection, filename: str, image_bytes: bytes, status: str,
+@st.cache_resource
+def ensure_ocr_tables_once(db_path: str) -> None:
+    """
+    Runs the OCR DDL once per DB path for the life of the server, so the
+    persist paths don't re-parse the CREATE ... IF NOT EXISTS script per click.
+    """
+    with get_conn() as conn:
+        ensure_ocr_tables(conn)
+
+def save_run(conn: sqlite3.Connection, filename: str, image_sha256: str, image_size: int, status: str,
              elapsed_ms: int, error_message: Optional[str] = None) -> int:
     cur = conn.cursor()
     cur.execute(
@@ -99,11 +168,50 @@ def save_run(conn: sqlite3.Connection, filename: str, image_bytes: bytes, status
         INSERT INTO ocr_runs (created_at, provider, filename, image_sha256, image_bytes, status, elapsed_ms, error_message)
         VALUES (?, ?, ?, ?, ?, ?, ?, ?)
         """,
-        (utc_now_iso(), "google_vision", filename, sha256_hex(image_bytes), len(image_bytes), status, elapsed_ms, error_message),
+        (utc_now_iso(), "google_vision", filename, image_sha256, image_size, status, elapsed_ms, error_message),
     )
-    run_id = int(cur.lastrowid)
-    conn.commit()
-    return run_id
+    return int(cur.lastrowid)
+
+def compress_full_text(full_text: str) -> bytes:
+    return zlib.compress(full_text.encode("utf-8"))
+
+def decompress_full_text(full_text: str, full_text_zlib: Optional[bytes]) -> str:
+    """
+    Rows written since full_text_zlib was added keep full_text empty and the OCR
+    text compressed in full_text_zlib; older rows only have full_text.
+    """
+    if full_text_zlib is None:
+        return full_text
+    return zlib.decompress(full_text_zlib).decode("utf-8")
+
+def load_cached_ocr_text(conn: sqlite3.Connection, image_sha256: str) -> Optional[str]:
+    """
+    OCR text from the latest successful run on the same image bytes, if any,
+    so re-uploads skip the Vision round-trip. Read-only: returns None when the OCR
+    tables haven't been created yet (no DDL here, since saving may be off).
+    """
+    tables = {r[0] for r in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name IN ('ocr_runs', 'ocr_results');"
+    )}
+    if len(tables) < 2:
+        return None
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(ocr_results);")}
+    zlib_col = "r.full_text_zlib" if "full_text_zlib" in cols else "NULL"
+
+    row = conn.execute(
+        f"""
+        SELECT r.full_text, {zlib_col}
+        FROM ocr_runs u
+        JOIN ocr_results r USING (run_id)
+        WHERE u.image_sha256 = ? AND u.status = 'success'
+        ORDER BY u.run_id DESC
+        LIMIT 1
+        """,
+        (image_sha256,),
+    ).fetchone()
+    if row is None:
+        return None
+    return decompress_full_text(row[0], row[1])
 
 def save_result(conn: sqlite3.Connection, run_id: int, full_text: str,
                 collector_raw: Optional[str], collector_norm: Optional[str],
@@ -116,17 +224,19 @@ def save_result(conn: sqlite3.Connection, run_id: int, full_text: str,
     conn.execute(
         """
         INSERT INTO ocr_results (
-          run_id, full_text,
+          run_id, full_text, full_text_zlib,
           collector_number_raw, collector_number_norm,
           promo_number_raw, promo_number_norm,
           pokemon_name,
           match_strategy, match_count,
           variant_product_count, variant_subtype_count
         )
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         """,
         (
-            run_id, full_text,
+            # The text lives only in full_text_zlib (see schema.sql); full_text is ''
+            # to satisfy NOT NULL, so read rows back with decompress_full_text
+            run_id, "", compress_full_text(full_text),
             collector_raw, collector_norm,
             promo_raw, promo_norm,
             pokemon_name,
@@ -134,17 +244,38 @@ def save_result(conn: sqlite3.Connection, run_id: int, full_text: str,
             variant_product_count, variant_subtype_count
         ),
     )
-    conn.commit()
 
 # -----------------------------
 # Parsing (number + name)
 # -----------------------------
 
+def parse_card_numbers(text: str) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Single pass over the OCR text. Returns (collector_raw, promo_raw): the first
+    slash number, and the first promo id (falling back to the first WOTC PROMO number).
+    """
+    slash: Optional[str] = None
+    promo: Optional[str] = None
+    wotc: Optional[str] = None
+    for m in CARD_NUMBER_RE.finditer(text or ""):
+        kind = m.lastgroup
+        if kind == "slash":
+            if slash is None:
+                slash = m.group("slash").replace(" ", "")
+        elif kind == "promo_num":
+            if promo is None:
+                prefix = m.group("promo_prefix").upper()
+                num = m.group("promo_num")
+                width = len(num)  # preserve SM05 style width
+                promo = f"{prefix}{int(num):0{width}d}" if num.startswith("0") else f"{prefix}{int(num)}"
+        elif wotc is None:
+            wotc = str(int(m.group("wotc_num")))
+        if slash is not None and promo is not None:
+            break
+    return slash, (promo if promo is not None else wotc)
+
 def parse_slash_number(text: str) -> Optional[str]:
-    m = SLASH_RE.search(text or "")
-    if not m:
-        return None
-    return m.group(1).replace(" ", "")
+    return parse_card_numbers(text)[0]
 
 def normalize_slash(raw: str) -> str:
     try:
@@ -154,21 +285,14 @@ def normalize_slash(raw: str) -> str:
         return raw.strip()
 
 def parse_promo_number(text: str) -> Optional[str]:
-    m = PROMO_RE.search(text or "")
-    if m:
-        prefix = m.group(1).upper()
-        num = m.group(2)
-        width = len(num)  # preserve SM05 style width
-        return f"{prefix}{int(num):0{width}d}" if num.startswith("0") else f"{prefix}{int(num)}"
-
-    m2 = WOTC_PROMO_NUM_RE.search(text or "")
-    if m2:
-        return str(int(m2.group(1)))
-
-    return None
+    return parse_card_numbers(text)[1]
 
 def normalize_promo(raw: str) -> str:
-    return re.sub(r"[\s\-]", "", (raw or "").strip()).upper()
+    return PROMO_SEP_RE.sub("", (raw or "").strip()).upper()
+
+def has_min_letters(s: str, n: int) -> bool:
+    """True once s has n alphabetic chars; stops scanning at the n-th instead of counting all."""
+    return next(islice(filter(str.isalpha, s), n - 1, None), None) is not None
 
 def extract_pokemon_name(text: str) -> Optional[str]:
     """
@@ -185,37 +309,30 @@ def extract_pokemon_name(text: str) -> Optional[str]:
     if not text:
         return None
 
-    lines = [ln.strip() for ln in text.splitlines() if ln.strip()]
-    # Search early lines first; then widen if needed
-    candidate_lines = lines[:30] + lines[30:60]
+    # Only the first 60 non-empty lines (the name sits near the top); stripped lazily,
+    # so the loop stops stripping as soon as a name is found
+    candidate_lines = islice(filter(None, map(str.strip, text.splitlines())), 60)
 
     for ln in candidate_lines:
         low = ln.lower()
 
         # reject boilerplate lines quickly
-        if any(tok in low for tok in ["weakness", "resistance", "retreat", "illus", "rule"]):
+        if NAME_BOILERPLATE_RE.search(low):
             continue
 
         # keep mostly alpha content
-        letters = sum(c.isalpha() for c in ln)
-        if letters < 4:
+        if not has_min_letters(ln, 4):
             continue
 
         # normalize: keep letters/digits/apostrophes/hyphens/spaces
-        cleaned = re.sub(r"[^A-Za-z0-9'’\-\s&]", " ", ln)
-        cleaned = re.sub(r"\s+", " ", cleaned).strip()
+        cleaned = NAME_CLEAN_RE.sub(" ", ln)
+        cleaned = WS_RE.sub(" ", cleaned).strip()
 
         # tokenize and drop stopwords / suffixes
         toks = cleaned.split()
         kept = []
         for t in toks:
-            tl = t.lower()
-            if tl in STOPWORDS:
-                continue
-            if tl in CARD_SUFFIXES:
-                continue
-            # drop lone punctuation-like tokens
-            if tl in {"&"}:
+            if t.lower() in NAME_DROP_TOKENS:
                 continue
             kept.append(t)
 
@@ -241,84 +358,72 @@ def extract_pokemon_name(text: str) -> Optional[str]:
 # DB matching
 # -----------------------------
 
+# Number column is one of two fixed names (never user input); the optional name
+# clause keeps cross-Pokémon collisions from ever leaving SQLite. Both filters are
+# on cards only, so SQLite applies them before the prices_latest join and probes
+# prices (one primary-key seek each) only for surviving cards; a separate
+# cards-then-prices fetch would add a round trip without skipping any join work.
+CANDIDATES_SQL = """
+    SELECT
+      c.product_id,
+      c.group_id,
+      c.product_name,
+      c.collector_number_raw,
+      c.collector_number_norm,
+      c.ext_number_raw,
+      c.ext_number_norm,
+      p.sub_type,
+      p.market_price,
+      p.updated_at
+    FROM cards c
+    LEFT JOIN prices_latest p ON p.product_id = c.product_id
+    WHERE c.{number_col} = :number
+      AND (:name IS NULL OR instr(lower(c.product_name), :name) > 0)
+    ORDER BY c.group_id, c.product_name, p.sub_type;
+"""
+
+def fetch_df(conn: sqlite3.Connection, sql: str, params: Dict[str, Any]) -> pd.DataFrame:
+    """
+    Plain cursor fetch into a DataFrame: skips read_sql_query's connection-type
+    detection and per-call wrapper overhead, which dominate for these small results.
+    """
+    cur = conn.cursor()
+    cur.row_factory = None  # plain tuples for from_records, whatever the connection uses
+    cur.execute(sql, params)
+    cols = [d[0] for d in cur.description]
+    return pd.DataFrame.from_records(cur.fetchall(), columns=cols, coerce_float=True)
+
 def query_candidates_by_number(
     conn: sqlite3.Connection,
     collector_norm: Optional[str],
     promo_norm: Optional[str],
-) -> Tuple[str | None, pd.DataFrame]:
+    pokemon_name: Optional[str] = None,
+) -> Tuple[str | None, pd.DataFrame, bool]:
     """
-    Returns (strategy, df).
+    Returns (strategy, df, applied_name_filter).
     Strategy is one of: 'collector_number_norm', 'ext_number_norm', or None.
-    """
-    if collector_norm:
-        df = pd.read_sql_query(
-            """
-            SELECT
-              c.product_id,
-              c.group_id,
-              c.product_name,
-              c.collector_number_raw,
-              c.collector_number_norm,
-              c.ext_number_raw,
-              c.ext_number_norm,
-              p.sub_type,
-              p.market_price,
-              p.updated_at
-            FROM cards c
-            LEFT JOIN prices_latest p ON p.product_id = c.product_id
-            WHERE c.collector_number_norm = ?
-            ORDER BY c.group_id, c.product_name, p.sub_type;
-            """,
-            conn,
-            params=[collector_norm],
-        )
-        return "collector_number_norm", df
-
-    if promo_norm:
-        df = pd.read_sql_query(
-            """
-            SELECT
-              c.product_id,
-              c.group_id,
-              c.product_name,
-              c.collector_number_raw,
-              c.collector_number_norm,
-              c.ext_number_raw,
-              c.ext_number_norm,
-              p.sub_type,
-              p.market_price,
-              p.updated_at
-            FROM cards c
-            LEFT JOIN prices_latest p ON p.product_id = c.product_id
-            WHERE c.ext_number_norm = ?
-            ORDER BY c.group_id, c.product_name, p.sub_type;
-            """,
-            conn,
-            params=[promo_norm],
-        )
-        return "ext_number_norm", df
-
-    return None, pd.DataFrame()
 
-def filter_candidates_by_pokemon_name(df: pd.DataFrame, pokemon_name: Optional[str]) -> Tuple[pd.DataFrame, bool]:
+    With pokemon_name, only cards whose product_name contains it (case-insensitive)
+    are returned, which filters OUT cross-Pokémon collisions while keeping all
+    variants of the same Pokémon. If that leaves nothing, the query is re-run
+    without the name (don't over-filter) and applied_name_filter is False.
     """
-    Filters OUT cross-Pokémon collisions while keeping all variants of the same Pokémon.
-
-    Returns (filtered_df, applied_filter).
-    If filtering yields empty, returns original df and applied_filter=False.
-    """
-    if df is None or df.empty or not pokemon_name:
-        return df, False
-
-    needle = pokemon_name.strip().lower()
-    if not needle:
-        return df, False
-
-    mask = df["product_name"].str.lower().str.contains(re.escape(needle), na=False)
-    filtered = df[mask].copy()
-    if filtered.empty:
-        return df, False  # don't over-filter
-    return filtered, True
+    if collector_norm:
+        strategy, number = "collector_number_norm", collector_norm
+    elif promo_norm:
+        strategy, number = "ext_number_norm", promo_norm
+    else:
+        return None, pd.DataFrame(), False
+
+    sql = CANDIDATES_SQL.format(number_col=strategy)
+    needle = (pokemon_name or "").strip().lower() or None
+    if needle:
+        df = fetch_df(conn, sql, {"number": number, "name": needle})
+        if not df.empty:
+            return strategy, df, True
+
+    df = fetch_df(conn, sql, {"number": number, "name": None})
+    return strategy, df, False
 
 def summarize_variants(df: pd.DataFrame) -> Dict[str, Any]:
     """
@@ -333,11 +438,11 @@ def summarize_variants(df: pd.DataFrame) -> Dict[str, Any]:
             "options_df": pd.DataFrame(),
         }
 
-    # Ensure uniqueness at (product_id, sub_type) level
+    # Ensure uniqueness at (product_id, sub_type) level. Dedupe before sorting so the
+    # sort only sees unique rows; ignore_index replaces the separate reset_index copy.
     opt = (
-        df.sort_values(["group_id", "product_name", "sub_type"])
-          .drop_duplicates(subset=["product_id", "sub_type"])
-          .reset_index(drop=True)
+        df.drop_duplicates(subset=["product_id", "sub_type"])
+          .sort_values(["group_id", "product_name", "sub_type"], ignore_index=True)
     )
 
     product_ct = int(opt["product_id"].nunique())
@@ -352,15 +457,65 @@ def summarize_variants(df: pd.DataFrame) -> Dict[str, Any]:
         "options_df": opt,
     }
 
+def option_labels(opt: pd.DataFrame) -> List[str]:
+    """
+    Dropdown labels built column-wise instead of a Python callback per row.
+    Missing prices show as N/A and missing sub_types as empty.
+    """
+    mp = pd.to_numeric(opt["market_price"], errors="coerce")
+    mp_s = mp.map("${:.2f}".format, na_action="ignore").fillna("N/A")
+    labels = (
+        opt["product_name"].astype(str)
+        + " | " + opt["sub_type"].fillna("").astype(str)
+        + " | " + mp_s
+        + " | group_id=" + opt["group_id"].astype(str)
+        + " | product_id=" + opt["product_id"].astype(str)
+    )
+    return labels.tolist()
+
 # -----------------------------
 # Google Vision OCR
 # -----------------------------
 
+@st.cache_resource
+def get_vision_client():
+    """
+    Built once per server: client construction does credential discovery and
+    gRPC channel setup, which would otherwise dominate small-image OCR calls.
+    """
+    from google.cloud import vision
+    return vision.ImageAnnotatorClient()
+
+def downscale_for_ocr(image_bytes: bytes) -> bytes:
+    """
+    Shrink oversized uploads (e.g. 4000x3000 phone photos) to OCR_MAX_SIDE on the
+    long side and re-encode as JPEG q=90, cutting upload size and Vision latency.
+    Small or unreadable images are sent as-is.
+    """
+    from PIL import Image, ImageOps  # ships with streamlit
+
+    # UnidentifiedImageError and truncated/corrupt data surface as OSError, possibly
+    # only once pixels are decoded in exif_transpose/thumbnail, not at open()
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            if max(img.size) <= OCR_MAX_SIDE:
+                return image_bytes
+            # Apply EXIF rotation first: re-encoding drops the orientation tag
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((OCR_MAX_SIDE, OCR_MAX_SIDE), Image.Resampling.LANCZOS)
+            if img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            out = io.BytesIO()
+            img.save(out, format="JPEG", quality=90)
+    except (OSError, Image.DecompressionBombError):
+        return image_bytes
+    small = out.getvalue()
+    return small if len(small) < len(image_bytes) else image_bytes
+
 def google_vision_ocr(image_bytes: bytes) -> str:
     from google.cloud import vision
-    client = vision.ImageAnnotatorClient()
     image = vision.Image(content=image_bytes)
-    resp = client.document_text_detection(image=image)
+    resp = get_vision_client().document_text_detection(image=image)
     if resp.error and resp.error.message:
         raise RuntimeError(resp.error.message)
     if resp.full_text_annotation and resp.full_text_annotation.text:
@@ -391,15 +546,24 @@ if st.button("Run Google OCR", type="primary"):
         st.error(f"SQLite DB not found at {DB_PATH.resolve()}. Create it (or disable saving).")
         st.stop()
 
+    # Hashed once per click, outside the OCR timing and the write transaction
+    image_sha256 = sha256_hex(image_bytes)
+
     t0 = time.time()
     try:
-        text = google_vision_ocr(image_bytes)
+        text = None
+        if DB_PATH.exists():
+            with get_conn() as conn:
+                text = load_cached_ocr_text(conn, image_sha256)
+        reused_text = text is not None
+        if reused_text:
+            st.info("Same image was OCR'd before; reusing its saved text.")
+        else:
+            text = google_vision_ocr(downscale_for_ocr(image_bytes))
         elapsed_ms = int((time.time() - t0) * 1000)
 
-        collector_raw = parse_slash_number(text)
+        collector_raw, promo_raw = parse_card_numbers(text)
         collector_norm = normalize_slash(collector_raw) if collector_raw else None
-
-        promo_raw = parse_promo_number(text)
         promo_norm = normalize_promo(promo_raw) if promo_raw else None
 
         pokemon_name = extract_pokemon_name(text)
@@ -410,8 +574,9 @@ if st.button("Run Google OCR", type="primary"):
 
         if DB_PATH.exists():
             with get_conn() as conn:
-                strategy, df = query_candidates_by_number(conn, collector_norm, promo_norm)
-                df, applied_name_filter = filter_candidates_by_pokemon_name(df, pokemon_name)
+                strategy, df, applied_name_filter = query_candidates_by_number(
+                    conn, collector_norm, promo_norm, pokemon_name
+                )
 
         summary = summarize_variants(df)
         has_variations = summary["has_variations"]
@@ -445,15 +610,7 @@ if st.button("Run Google OCR", type="primary"):
         if options_df is not None and not options_df.empty:
             st.subheader("Variant Selection (dropdown)")
 
-            def label_row(r: pd.Series) -> str:
-                mp = r.get("market_price")
-                mp_s = f"${mp:.2f}" if isinstance(mp, (int, float)) and mp is not None else "N/A"
-                return f"{r['product_name']} | {r.get('sub_type','')} | {mp_s} | group_id={r['group_id']} | product_id={r['product_id']}"
-
-            options_df = options_df.copy()
-            options_df["label"] = options_df.apply(label_row, axis=1)
-
-            labels = options_df["label"].tolist()
+            labels = option_labels(options_df)
             idx = st.selectbox("Choose the correct variant", range(len(labels)), format_func=lambda i: labels[i])
 
             chosen = options_df.iloc[int(idx)].to_dict()
@@ -474,10 +631,14 @@ if st.button("Run Google OCR", type="primary"):
             st.subheader("DB Match Candidates (post-filter)")
             st.dataframe(df, use_container_width=True, hide_index=True)
 
-        if persist:
+        if persist and reused_text:
+            # No Vision call was made, so there is no new run to log
+            st.info("Not saved: this image's OCR run is already stored.")
+        elif persist:
+            ensure_ocr_tables_once(str(DB_PATH))
+            # save_run/save_result don't commit; both rows go in one transaction
             with get_conn() as conn:
-                ensure_ocr_tables(conn)
-                run_id = save_run(conn, up.name, image_bytes, status="success", elapsed_ms=elapsed_ms)
+                run_id = save_run(conn, up.name, image_sha256, len(image_bytes), status="success", elapsed_ms=elapsed_ms)
                 save_result(
                     conn,
                     run_id,
@@ -501,7 +662,7 @@ if st.button("Run Google OCR", type="primary"):
         st.error("OCR failed: " + msg)
 
         if persist and DB_PATH.exists():
+            ensure_ocr_tables_once(str(DB_PATH))
             with get_conn() as conn:
-                ensure_ocr_tables(conn)
-                run_id = save_run(conn, up.name, image_bytes, status="error", elapsed_ms=elapsed_ms, error_message=msg)
+                run_id = save_run(conn, up.name, image_sha256, len(image_bytes), status="error", elapsed_ms=elapsed_ms, error_message=msg)
             st.warning(f"Saved failed OCR run_id={run_id} to {DB_PATH}")